@@ -3,72 +3,140 @@
 Optimized async HTTP API for sending iMessages via imessage_monitor.
 Includes:
  - Scalable single-producer queue for outbound messages
- - Unified async send worker
+ - Pool of async send workers
  - Shared httpx client
- - Simplified inbound forwarding
+ - Bounded inbound forwarding queue
  - Clean FaceTime watcher & restart logic
 """
 
 from __future__ import annotations
 
 import os
+import sys
 import asyncio
-import subprocess
+import functools
+import importlib.util
+import tempfile
+import contextlib
+from contextlib import asynccontextmanager
+import shutil
 from typing import Optional, Annotated
 
-from fastapi import FastAPI, HTTPException, Request, status
-from pydantic import BaseModel, Field, model_validator
+from fastapi import Depends, FastAPI, HTTPException, Request, status
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, StringConstraints
 import httpx
+import orjson
 import uvicorn
+from dotenv import load_dotenv
 import time
 import re
 import asyncio
 import hashlib
+import hmac
+import weakref
+import atexit
+import logging
+import logging.handlers
+import queue
+from collections import OrderedDict
 
 from imessage_monitor.monitor import iMessageMonitor
 from imessage_monitor.outbound import OutboundMessageSender
 from imessage_monitor.exceptions import OutboundMessageError
 
+# Pick up per-deployment settings (NGROK_URL, IMESSAGE_API_KEY, ...) from .env;
+# variables already exported in the environment win.
+load_dotenv()
+
 
 COOLDOWN = 20  # per-call cooldown
 GLOBAL_DEBOUNCE = 2  # prevent burst duplicates
-cooldowns = {}
+COOLDOWN_MAX_ENTRIES = 4096
+cooldowns: OrderedDict[str, float] = OrderedDict()  # call_id -> last seen, oldest first
 last_global = 0
 
-UUID_REGEX = r"[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}"
+FACETIME_REPLY_TO = "7345893340"
+FACETIME_REPLY_TEXT = (
+    "Corn On The Corner, This is our storefront location: "
+    "1041 Howard St, Dearborn, MI 48124. Please text your order "
+    "including a name and confirm the given pick up time. Thank you."
+)
+
+LOG_STREAM_LIMIT = 2**20  # max bytes buffered for a single log line
+
+# Let logd do the filtering so irrelevant lines never reach the pipe
+LOG_PREDICATE = '(eventMessage CONTAINS[c] "FaceTime") AND (eventMessage CONTAINS[c] "incoming")'
+
+UUID_RE = re.compile(
+    rb"[0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12}"
+)
 
 
 # ================================================================
 #                  MODELS / VALIDATION
 # ================================================================
 
-NonEmptyStr = Annotated[str, Field(min_length=1)]
+NonEmptyStr = Annotated[str, StringConstraints(strip_whitespace=True, min_length=1)]
+MessageStr = Annotated[
+    str, StringConstraints(strip_whitespace=True, min_length=1, max_length=10000)
+]
 
 class SendRequest(BaseModel):
     to: NonEmptyStr
-    message: Annotated[str, Field(min_length=1, max_length=10000)]
+    message: MessageStr
+
+
+# ================================================================
+#                  LOGGING
+# ================================================================
+
+def _setup_logging() -> logging.Logger:
+    """Route log records through a queue so stream writes happen off the event loop."""
+    logger = logging.getLogger("imessage_gateway")
+    if logger.handlers:  # module imported twice (`python app.py` + uvicorn)
+        return logger
+
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(logging.INFO)
+    logger.propagate = False
+
+    listener = logging.handlers.QueueListener(log_queue, logging.StreamHandler())
+    listener.start()
+    atexit.register(listener.stop)
+    return logger
 
-    @model_validator(mode="before")
-    def strip_whitespace(cls, values):
-        if isinstance(values.get("to"), str):
-            values["to"] = values["to"].strip()
-        if isinstance(values.get("message"), str):
-            values["message"] = values["message"].strip()
-        return values
+
+log = _setup_logging()
 
 
 # ================================================================
 #                  GLOBALS — SINGLETONS
 # ================================================================
-app = FastAPI(title="iMessage HTTP API", version="0.2.0")
-
 monitor: Optional[iMessageMonitor] = None
 outbound: Optional[OutboundMessageSender] = None
 
 SEND_QUEUE: asyncio.Queue = asyncio.Queue()
-HTTP = httpx.AsyncClient(timeout=10)
-
-API_KEY = os.environ.get("IMESSAGE_API_KEY", "changeme")
+# At least one worker, or /send would report "queued" while nothing is ever sent
+SEND_WORKERS = max(1, int(os.environ.get("SEND_WORKERS", "4")))
+SEND_SEM = asyncio.Semaphore(SEND_WORKERS)
+# Entries disappear once no batch for that recipient is pending.
+RECIPIENT_LOCKS: weakref.WeakValueDictionary[str, asyncio.Lock] = weakref.WeakValueDictionary()
+FORWARD_QUEUE: asyncio.Queue = asyncio.Queue(maxsize=1024)
+# At least one worker, or every inbound message is dropped once the queue fills
+FORWARD_WORKERS = max(1, int(os.environ.get("FORWARD_WORKERS", "8")))
+# Inbound forward target; per-deployment, so read from the environment
+FORWARD_URL = httpx.URL(os.environ.get("NGROK_URL") or "https://zappd.app/sms/reply")
+JSON_HEADERS = {"content-type": "application/json"}
+
+# Shared forwarding client; created and closed by lifespan
+HTTP: Optional[httpx.AsyncClient] = None
+
+DEFAULT_API_KEY = "changeme"
+API_KEY = os.environ.get("IMESSAGE_API_KEY", DEFAULT_API_KEY)
+API_KEY_BYTES = API_KEY.encode()
+BEARER_PREFIX = b"Bearer "
 
 APPLE_SCRIPT = '''
 set appName to "FaceTime"
@@ -120,6 +188,11 @@ tell application "System Events"
 end tell
 '''
 
+# osascript argv for each script; swapped for precompiled .scpt paths at startup
+RESTART_CMD: list[str] = ["osascript", "-e", APPLE_SCRIPT]
+DECLINE_CMD: list[str] = ["osascript", "-e", APPLE_DECLINE_ONLY]
+APPLESCRIPT_DIR: Optional[str] = None
+RESTART_TIMEOUT = 5  # seconds before a hung osascript is killed
 
 
 # ================================================================
@@ -127,12 +200,12 @@ end tell
 # ================================================================
 
 async def require_api_key(request: Request):
-    auth = request.headers.get("Authorization")
-    if not auth or not auth.startswith("Bearer "):
+    auth = request.headers.get("authorization", "").encode()
+    if not auth.startswith(BEARER_PREFIX):
         raise HTTPException(401, "Missing or invalid Authorization header")
 
-    key = auth.split(" ", 1)[1].strip()
-    if key != API_KEY:
+    # Constant-time compare so the key can't be recovered from response timing
+    if not hmac.compare_digest(auth[len(BEARER_PREFIX):].strip(), API_KEY_BYTES):
         raise HTTPException(403, "Invalid API key")
 
     return True
@@ -142,19 +215,48 @@ async def require_api_key(request: Request):
 #                  OUTBOUND QUEUE WORKER
 # ================================================================
 
+async def _send_one(outbound: OutboundMessageSender, to: str, message: str):
+    try:
+        async with SEND_SEM:
+            await outbound.send_message(to, message)
+        log.info("📤 Sent message to %s", to)
+    except OutboundMessageError as exc:
+        log.error("❌ OutboundMessageError sending to %s: %s", to, exc)
+    except Exception as exc:
+        log.error("❌ Unexpected send error to %s: %s", to, exc)
+
+
+async def _send_batch(outbound: OutboundMessageSender, to: str, messages: list[str]):
+    """Send one recipient's messages in the order they were queued."""
+    lock = RECIPIENT_LOCKS.get(to)
+    if lock is None:
+        lock = RECIPIENT_LOCKS[to] = asyncio.Lock()
+    async with lock:
+        for message in messages:
+            await _send_one(outbound, to, message)
+
+
 async def send_worker(outbound: OutboundMessageSender):
-    """Single worker that processes SEND_QUEUE sequentially."""
+    """Drain SEND_QUEUE in bursts, sending to distinct recipients concurrently."""
     while True:
-        to, message = await SEND_QUEUE.get()
+        items = [await SEND_QUEUE.get()]
+        while True:
+            try:
+                items.append(SEND_QUEUE.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+
+        by_to: dict[str, list[str]] = {}
+        for to, message in items:
+            by_to.setdefault(to, []).append(message)
+
         try:
-            await outbound.send_message(to, message)
-            print(f"📤 Sent message to {to}")
-        except OutboundMessageError as exc:
-            print(f"❌ OutboundMessageError sending to {to}: {exc}")
-        except Exception as exc:
-            print(f"❌ Unexpected send error to {to}: {exc}")
+            await asyncio.gather(
+                *(_send_batch(outbound, to, msgs) for to, msgs in by_to.items())
+            )
         finally:
-            SEND_QUEUE.task_done()
+            for _ in items:
+                SEND_QUEUE.task_done()
 
 
 async def enqueue_send(to: str, message: str):
@@ -191,101 +293,230 @@ async def forward_incoming_message(message: dict):
 
     try:
         await HTTP.post(
-            "https://zappd.app/sms/reply",
-            json=payload,
+            FORWARD_URL, content=orjson.dumps(payload), headers=JSON_HEADERS
         )
-        print(f"➡️ Forwarded inbound message from {sender}")
+        log.info("➡️ Forwarded inbound message from %s", sender)
+    except Exception as e:
+        log.warning("⚠️ Failed to forward inbound message: %s", e)
+
+
+def enqueue_forward(message: dict):
+    """Queue an inbound message for forwarding; must run on the event loop."""
+    try:
+        FORWARD_QUEUE.put_nowait(message)
+    except asyncio.QueueFull:
+        log.warning("⚠️ Forward queue full, dropping inbound message")
+
+
+async def forward_worker():
+    """Forward queued inbound messages; FORWARD_WORKERS of these bound in-flight posts."""
+    while True:
+        message = await FORWARD_QUEUE.get()
+        try:
+            await forward_incoming_message(message)
+        except Exception as exc:
+            log.error("❌ Unexpected forward error: %s", exc)
+        finally:
+            FORWARD_QUEUE.task_done()
+
+
+def make_http_client() -> httpx.AsyncClient:
+    # Every forward goes to the same host, so keep a few long-lived HTTP/2
+    # connections around instead of re-handshaking TLS on each burst.
+    return httpx.AsyncClient(
+        http2=True,
+        timeout=httpx.Timeout(10.0, connect=3.0),
+        limits=httpx.Limits(
+            max_connections=64,
+            max_keepalive_connections=32,
+            keepalive_expiry=1800,
+        ),
+    )
+
+
+async def warm_http_pool():
+    """Open a connection to the forward host so the first real forward skips TLS setup."""
+    try:
+        # HEAD the origin, not the webhook route, so no spurious inbound event is sent
+        await HTTP.head(FORWARD_URL.copy_with(path="/", query=None), timeout=3)
     except Exception as e:
-        print(f"⚠️ Failed to forward inbound message: {e}")
+        log.warning("⚠️ HTTP pool warm-up failed: %s", e)
 
 
 # ================================================================
 #                  FACETIME WATCH / AUTO-RESTART
 # ================================================================
 
+async def compile_applescript(source: str, name: str, workdir: str) -> list[str]:
+    """Compile an AppleScript once with osacompile; returns the osascript argv to run it."""
+    src_path = os.path.join(workdir, f"{name}.applescript")
+    scpt_path = os.path.join(workdir, f"{name}.scpt")
+    with open(src_path, "w", encoding="utf-8") as f:
+        f.write(source)
+
+    process = await asyncio.create_subprocess_exec(
+        "osacompile", "-o", scpt_path, src_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    _, stderr = await process.communicate()
+    if process.returncode != 0:
+        log.warning(
+            "⚠️ osacompile failed for %s, running from source: %s",
+            name, stderr.decode().strip(),
+        )
+        return ["osascript", "-e", source]
+
+    return ["osascript", scpt_path]
+
+
+async def precompile_applescripts():
+    global RESTART_CMD, DECLINE_CMD, APPLESCRIPT_DIR
+
+    try:
+        APPLESCRIPT_DIR = tempfile.mkdtemp(prefix="imessage-gateway-")
+        RESTART_CMD = await compile_applescript(APPLE_SCRIPT, "restart", APPLESCRIPT_DIR)
+        DECLINE_CMD = await compile_applescript(APPLE_DECLINE_ONLY, "decline", APPLESCRIPT_DIR)
+    except OSError as e:
+        log.warning("⚠️ Could not precompile AppleScripts: %s", e)
+
+
 async def restart_messages():
+    process = await asyncio.create_subprocess_exec(
+        *RESTART_CMD,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE,
+    )
     try:
-        subprocess.run(["osascript", "-e", APPLE_SCRIPT], check=True)
-        print("🔄 Messages app restarted")
-    except subprocess.CalledProcessError as e:
-        print(f"⚠️ AppleScript error: {e}")
+        _, stderr = await asyncio.wait_for(
+            process.communicate(), timeout=RESTART_TIMEOUT
+        )
+    except asyncio.TimeoutError:
+        # osascript may exit on its own between the timeout and the kill
+        with contextlib.suppress(ProcessLookupError):
+            process.kill()
+        await process.wait()
+        log.warning("⚠️ AppleScript timed out after %ss", RESTART_TIMEOUT)
+        return
+
+    if process.returncode != 0:
+        log.warning(
+            "⚠️ AppleScript error (exit %s): %s",
+            process.returncode, stderr.decode().strip(),
+        )
+        return
+    log.info("🔄 Messages app restarted")
 
 async def run_auto_decline_applescript():
     process = await asyncio.create_subprocess_exec(
-        "osascript", "-e", APPLE_DECLINE_ONLY,
+        *DECLINE_CMD,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
     )
     stdout, stderr = await process.communicate()
 
     if stdout:
-        print("📟 AppleScript output:", stdout.decode())
+        log.info("📟 AppleScript output: %s", stdout.decode())
     if stderr:
-        print("⚠️ AppleScript error:", stderr.decode())
+        log.warning("⚠️ AppleScript error: %s", stderr.decode())
 
-async def watch_for_facetime_notifications():
-    global cooldowns, last_global
+async def handle_facetime_line(line: bytes):
+    global last_global
 
-    process = await asyncio.create_subprocess_shell(
-        "log stream --predicate 'eventMessage contains \"FaceTime\"' --info",
-        stdout=asyncio.subprocess.PIPE,
-        stderr=asyncio.subprocess.PIPE,
-    )
+    # `log stream` echoes the predicate (which contains "incoming") and
+    # a column header before any events
+    if line.startswith((b"Filtering the log data", b"Timestamp")):
+        return
 
-    while True:
-        line = await process.stdout.readline()
-        if not line:
-            break
+    # ---- Unified UUID extraction ----
+    # Matched on raw bytes; only the hex id itself is ever decoded
+    match = UUID_RE.search(line)
+    if match:
+        call_id = match.group(0).replace(b"-", b"").decode("ascii")
+    else:
+        # Stable fallback
+        call_id = "fallback-" + hashlib.blake2b(line, digest_size=8).hexdigest()
 
-        text = line.decode("utf-8", "ignore")
+    now = time.time()
 
-        if "incoming" not in text.lower():
-            continue
+    # ---- Global debounce ----
+    if now - last_global < GLOBAL_DEBOUNCE:
+        return
+    last_global = now
 
-        # ---- Unified UUID extraction ----
-        match = re.search(UUID_REGEX, text)
-        if match:
-            call_id = match.group(0).replace("-", "")
-        else:
-            # Stable fallback
-            call_id = "fallback-" + hashlib.sha1(text.encode()).hexdigest()[:12]
+    # ---- Per-call cooldown ----
+    last_event = cooldowns.get(call_id, 0)
+    if now - last_event < COOLDOWN:
+        log.info("⚠️ Duplicate prevented (cooldown): %s", call_id)
+        return
 
-        now = time.time()
+    cooldowns[call_id] = now
+    cooldowns.move_to_end(call_id)
 
-        # ---- Global debounce ----
-        if now - last_global < GLOBAL_DEBOUNCE:
-            continue
-        last_global = now
+    # Oldest entries sit at the front; drop expired and overflow ones
+    while cooldowns:
+        oldest_ts = next(iter(cooldowns.values()))
+        if now - oldest_ts < COOLDOWN and len(cooldowns) <= COOLDOWN_MAX_ENTRIES:
+            break
+        cooldowns.popitem(last=False)
 
-        # ---- Per-call cooldown ----
-        last_event = cooldowns.get(call_id, 0)
-        if now - last_event < COOLDOWN:
-            print("⚠️ Duplicate prevented (cooldown):", call_id)
-            continue
+    log.info("📞 Incoming FaceTime (ID=%s) → restarting Messages", call_id)
 
-        cooldowns[call_id] = now
+    await restart_messages()
 
-        print(f"📞 Incoming FaceTime (ID={call_id}) → restarting Messages")
+    await enqueue_send(FACETIME_REPLY_TO, FACETIME_REPLY_TEXT)
 
-        await restart_messages()
 
-        await enqueue_send(
-            "7345893340",
-            "Corn On The Corner, This is our storefront location: "
-            "1041 Howard St, Dearborn, MI 48124. Please text your order "
-            "including a name and confirm the given pick up time. Thank you."
-        )
+async def watch_for_facetime_notifications():
+    process = await asyncio.create_subprocess_exec(
+        "log", "stream",
+        "--predicate", LOG_PREDICATE,
+        "--info",
+        "--style", "compact",
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.DEVNULL,
+        limit=LOG_STREAM_LIMIT,
+    )
+
+    try:
+        # Read in large chunks and split ourselves: one loop wakeup per chunk
+        # instead of one per log line
+        buf = b""
+        while chunk := await process.stdout.read(65536):
+            buf += chunk
+            if b"\n" in chunk:
+                *lines, buf = buf.split(b"\n")
+                for line in lines:
+                    if line:
+                        await handle_facetime_line(line)
+
+            # Same bound readline() enforced: drop a runaway unterminated line
+            if len(buf) > LOG_STREAM_LIMIT:
+                log.warning(
+                    "⚠️ Discarding %d bytes of log stream output without a newline",
+                    len(buf),
+                )
+                buf = b""
+
+        if buf:
+            await handle_facetime_line(buf)
+    finally:
+        # Cancellation on shutdown must not orphan the `log stream` child
+        if process.returncode is None:
+            with contextlib.suppress(ProcessLookupError):
+                process.kill()
+            await process.wait()
 
 
 # ================================================================
-#                  STARTUP / SHUTDOWN
+#                  LIFESPAN
 # ================================================================
 
-@app.on_event("startup")
-async def startup_event():
-    global monitor, outbound
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global monitor, outbound, HTTP
 
-    loop = asyncio.get_event_loop()
+    loop = asyncio.get_running_loop()
 
     monitor = iMessageMonitor()
     outbound = OutboundMessageSender(monitor.config)
@@ -293,35 +524,63 @@ async def startup_event():
     # Register inbound callback
     # Monitor is always checking the OS to see if a message is recieved
     # If recieved will send to application
+    # The callback fires on the monitor's thread, so hop onto the loop first
     monitor.start(
-        message_callback=lambda msg: loop.create_task(
-            forward_incoming_message(msg)
-        )
+        message_callback=functools.partial(loop.call_soon_threadsafe, enqueue_forward)
     )
 
-    asyncio.create_task(send_worker(outbound))
-    asyncio.create_task(watch_for_facetime_notifications())
-
-    print("✅ iMessage monitor started")
-    print("🚀 Outbound queue worker running")
-    print("📞 FaceTime watcher started")
-
-
-@app.on_event("shutdown")
-async def shutdown_event():
-    global monitor
+    # Everything after monitor.start() is covered so a failed startup still tears down
+    tasks: list[asyncio.Task] = []
     try:
-        if monitor:
-            monitor.stop()
-    except Exception:
-        pass
+        HTTP = make_http_client()
+        await precompile_applescripts()
+
+        tasks += [asyncio.create_task(send_worker(outbound)) for _ in range(SEND_WORKERS)]
+        tasks += [asyncio.create_task(forward_worker()) for _ in range(FORWARD_WORKERS)]
+        tasks.append(asyncio.create_task(watch_for_facetime_notifications()))
+        tasks.append(asyncio.create_task(warm_http_pool()))
+
+        log.info("✅ iMessage monitor started")
+        log.info("🚀 %d outbound queue workers running", SEND_WORKERS)
+        log.info("➡️ %d inbound forward workers running", FORWARD_WORKERS)
+        log.info("📞 FaceTime watcher started")
+        if API_KEY == DEFAULT_API_KEY:
+            log.warning("⚠️ IMESSAGE_API_KEY is unset; /send accepts the default key %r", DEFAULT_API_KEY)
+
+        yield
+    finally:
+        # Stop the producer first so nothing lands on FORWARD_QUEUE after its
+        # workers are gone
+        try:
+            if monitor:
+                monitor.stop()
+        except Exception:
+            pass
+
+        # Workers loop forever; cancel and reap them so reloads don't leak tasks
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if HTTP:
+            await HTTP.aclose()
+            HTTP = None
+        if APPLESCRIPT_DIR:
+            shutil.rmtree(APPLESCRIPT_DIR, ignore_errors=True)
+
+
+app = FastAPI(
+    title="iMessage HTTP API",
+    version="0.2.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
 
 
 # ================================================================
 #                  API ROUTES
 # ================================================================
 
-@app.post("/send")
+@app.post("/send", dependencies=[Depends(require_api_key)])
 async def send_message(req: SendRequest):
     # Recieves message from application and puts it in a queue
     # macOS is responsible for sending messages
@@ -336,5 +595,21 @@ async def send_message(req: SendRequest):
 if __name__ == "__main__":
     host = os.environ.get("IMESSAGE_HOST", "127.0.0.1")
     port = int(os.environ.get("IMESSAGE_PORT", "8000"))
-    print(f"Starting on http://{host}:{port}")
-    uvicorn.run("app:app", host=host, port=port, log_level="info")
\ No newline at end of file
+    # Each worker runs its own monitor + FaceTime watcher, so >1 duplicates
+    # inbound forwards; only raise this if those are disabled elsewhere.
+    workers = int(os.environ.get("IMESSAGE_WORKERS", "1"))
+    # Only pin the fast implementations when installed (uvicorn[standard]);
+    # plain uvicorn otherwise falls back to asyncio / h11 via "auto"
+    has_uvloop = sys.platform != "win32" and importlib.util.find_spec("uvloop")
+    loop = "uvloop" if has_uvloop else "auto"
+    http = "httptools" if importlib.util.find_spec("httptools") else "auto"
+    log.info("Starting on http://%s:%s", host, port)
+    uvicorn.run(
+        "app:app",
+        host=host,
+        port=port,
+        log_level="info",
+        loop=loop,
+        http=http,
+        workers=workers,
+    )